@@ -4,7 +4,17 @@ import pandas as pd
 import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
+import types
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+try:
+    from numba import njit, prange
+except ImportError:
+    # 未安裝 numba 時退回純 Python 執行 (結果相同，只是較慢)
+    prange = range
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]) and not kwargs: return args[0]
+        return lambda func: func
 
 # --- 1. 頁面設定 ---
 st.set_page_config(page_title="全方位資產成長模擬器 (信貸還款完整版)", layout="wide", page_icon="📈")
@@ -14,12 +24,31 @@ def calculate_pmt(rate, nper, pv):
     if rate == 0: return -(pv / nper)
     return -(pv * rate * (1 + rate)**nper) / ((1 + rate)**nper - 1)
 
+# 閉式還款表：第 k 期末餘額 B_k = L(1+r)^k - P((1+r)^k - 1)/r (繳清後為 0)
+# 回傳第 0..n 期末餘額與第 1..n 期的實際繳款 (利息 + 本金，最後一期只繳剩餘本金)
+def loan_schedule(loan_amount, loan_rate, monthly_payment, interest_only, n_months):
+    rate = loan_rate / 12
+    k = np.arange(n_months + 1)
+    if interest_only:
+        balance = np.full(n_months + 1, float(loan_amount))
+    elif rate == 0:
+        balance = np.maximum(0.0, loan_amount - monthly_payment * k)
+    else:
+        growth = (1 + rate) ** k
+        balance = np.maximum(0.0, loan_amount * growth - monthly_payment * (growth - 1) / rate)
+    # 閉式解在繳清那一期常留下 1e-9 等級的浮點殘值，若不歸零下個月會多扣一筆微小「還款」，
+    # 讓現金變負而觸發額外再平衡；真實餘額在繳清前至少約一期月付額，遠大於此容許值
+    if not interest_only: balance[balance <= loan_amount * 1e-9] = 0.0
+    payment = balance[:-1] * rate + (balance[:-1] - balance[1:])
+    return balance, payment
+
 # --- 2. 側邊欄：參數設定 ---
 st.sidebar.header("⚙️ 模擬參數設定")
 
 # (A) 時間設定
 years_back = st.sidebar.slider("回測年數", 1, 20, 7)
-end_date = datetime.now()
+# 日期只取到「日」(結束日為明天 0 點，含今日資料)，讓下載快取在同一天內能命中
+end_date = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
 requested_start_date = end_date - timedelta(days=years_back*365)
 
 # (B) 標的與配置
@@ -94,34 +123,248 @@ if use_leverage:
 
 # (E) 再平衡策略
 st.sidebar.subheader("⚖️ 再平衡策略")
-rebalance_mode = st.sidebar.selectbox("再平衡頻率", ["每月 (Monthly)", "每年 (Yearly)", "不進行 (Buy & Hold)"], index=1)
+REBALANCE_MODES = ["每月 (Monthly)", "每年 (Yearly)", "不進行 (Buy & Hold)"]  # 索引即回測核心的 rebalance_code
+rebalance_mode = st.sidebar.selectbox("再平衡頻率", REBALANCE_MODES, index=1)
 threshold_mode = st.sidebar.checkbox("啟用偏移閾值 (Threshold)")
 threshold_pct = 0.05
 if threshold_mode:
     threshold_pct = st.sidebar.slider("容許偏移值 (%)", 1, 20, 5) / 100
 
 # --- 3. 核心函數 ---
-def get_data_safe(ticker_list, start, end):
+# 單一標的下載 (快取 1 小時)：不同組合中重複出現的標的共用同一份下載
+# 回傳以代號命名的價格序列；失敗時拋出例外，避免把失敗結果快取起來
+@st.cache_data(ttl=3600, show_spinner=False)
+def _download_one(ticker, start, end):
+    df = yf.download(ticker, start=start, end=end, progress=False, auto_adjust=False, threads=False)
+    target_col = next((c for c in ('Adj Close', 'Close') if c in df.columns), None)
+    if df.empty or not target_col: raise ValueError(f"無法取得 {ticker} 的資料")
+    data = df[target_col]
+    if isinstance(data, pd.DataFrame): data = data.iloc[:, 0]
+    return data.rename(ticker)
+
+# 下載結果快取 1 小時：調整權重/信貸等參數重跑時不必重新向 Yahoo 下載 (ticker 需為 tuple 才能 hash)
+# 各標的以執行緒平行下載，延遲由 N 次往返降為最慢的一次 (並行由這裡控制，單檔下載不再讓 yfinance 另開執行緒)
+# 失敗時直接拋出例外，st.cache_data 不會快取例外，下次按下按鈕會重新下載
+@st.cache_data(ttl=3600, show_spinner=False)
+def _get_data(ticker_tuple, start, end):
+    ticker_list = list(dict.fromkeys(ticker_tuple))
+    with ThreadPoolExecutor(max_workers=min(len(ticker_list), 8)) as pool:
+        series = list(pool.map(lambda t: _download_one(t, start, end), ticker_list))
+    data = pd.concat(series, axis=1)
+    return data.ffill().dropna()
+
+# 不快取的外層：把下載失敗轉成空的 DataFrame 給畫面顯示錯誤訊息 (暫時性的網路錯誤不會被快取一小時)
+def get_data_safe(ticker_tuple, start, end):
     try:
-        df = yf.download(ticker_list, start=start, end=end, progress=False, auto_adjust=False)
-        if df.empty: return pd.DataFrame()
-        target_col = 'Adj Close' if 'Adj Close' in df.columns else ('Close' if 'Close' in df.columns else None)
-        if not target_col: return pd.DataFrame()
-        data = df[target_col]
-        if isinstance(data, pd.Series):
-            data = data.to_frame(); data.columns = ticker_list
-        elif isinstance(data, pd.DataFrame):
-            if len(ticker_list) == 1 and len(data.columns) == 1: data.columns = ticker_list
-        return data.ffill().dropna()
+        return _get_data(ticker_tuple, start, end)
     except Exception as e:
         return pd.DataFrame()
+
+# 回測核心 (Numba 編譯)：逐日狀態機只接受 NumPy 陣列與純量，結果寫入預先配置的輸出陣列
+# 可一次跑 K 組再平衡情境 (rebalance_code / threshold_on / threshold_pct 皆為長度 K)，共用同一份價格與現金流
+# 各情境彼此獨立，外層以 prange 跑 K：平行版本 (策略掃描) 分散到多核心，一般版本等同普通迴圈
+# 信貸不受投資組合影響，已預先算成每日的現金流 cash_flow 與信貸餘額 loan_balance
+def _simulate(prices, is_new_month, is_year_start, weights, start_total_assets, cash_weight, cash_rate,
+              cash_flow, loan_balance, rebalance_code, threshold_on, threshold_pct, net_worth, cash):
+    T, N = prices.shape
+    K = len(rebalance_code)
+    daily_cash_factor = 1.0 + cash_rate / 365.0
+
+    for k in prange(K):
+        current_cash = start_total_assets * cash_weight
+        shares = np.empty(N); vals = np.empty(N); target_vals = np.empty(N)
+        for j in range(N):
+            shares[j] = start_total_assets * weights[j] / prices[0, j]
+
+        for i in range(T):
+            current_cash = current_cash * daily_cash_factor + cash_flow[i]
+
+            # 市值只算一次，偏移檢查與再平衡共用同一組目標配置 target_vals
+            stock_val = 0.0
+            for j in range(N):
+                vals[j] = shares[j] * prices[i, j]
+                stock_val += vals[j]
+            total_assets = current_cash + stock_val
+            net_worth[k, i] = total_assets - loan_balance[i]
+
+            do_rebalance = current_cash < 0
+            if rebalance_code[k] == 0 and is_new_month[i]: do_rebalance = True
+            elif rebalance_code[k] == 1 and is_year_start[i]: do_rebalance = True
+
+            # 目標配置只在需要偏移檢查或當天要再平衡時才計算；未啟用閾值的平日只做上面的市值加總
+            # 同一趟順便取最大偏移量 (完整 max 歸約、無提早 break，編譯器可向量化)
+            check_drift = threshold_on[k] and total_assets > 0
+            if check_drift or do_rebalance:
+                max_dev = 0.0
+                for j in range(N):
+                    target_vals[j] = total_assets * weights[j]
+                    max_dev = max(max_dev, abs(vals[j] - target_vals[j]))
+                if check_drift and max_dev > threshold_pct[k] * total_assets: do_rebalance = True
+
+            if do_rebalance and total_assets > 0:
+                for j in range(N):
+                    shares[j] = target_vals[j] / prices[i, j]
+                # 再平衡後現金即為現金權重 cash_weight (由整數百分比算出，全額投入時恰為 0)；
+                # 不用 1 - sum(weights)，浮點加總可能略大於 1，使現金變成負值而每天觸發再平衡
+                current_cash = total_assets * cash_weight
+
+            cash[k, i] = current_cash
+
+# 編譯後的核心以 st.cache_resource 在整個伺服器程序共用：Streamlit 每次 rerun 都會重新執行本檔，
+# 直接掛 @njit 會讓每次 rerun / 每個新 session 都重新載入磁碟快取並解析型別
+# 明確宣告型別簽章：第一次取用時即編譯並寫入磁碟快取，之後的程序直接載入
+SIM_SIG = "void(f4[:, ::1], b1[::1], b1[::1], f8[::1], f8, f8, f8, f8[::1], f8[::1], i8[::1], b1[::1], f8[::1], f8[:, ::1], f8[:, ::1])"
+
+@st.cache_resource(show_spinner=False)
+def get_simulator():
+    # 標的最多 5 檔，逐日開執行緒 (prange) 的成本遠大於收益；改放寬浮點重排 (reassoc/contract)，讓每檔標的的加總與乘加可向量化
+    return njit(SIM_SIG, fastmath={"reassoc", "contract"}, cache=True)(_simulate)
+
+# 策略掃描用的平行版本：同一個核心，K 組情境分散到各核心
+# Numba 磁碟快取以函式名稱 (qualname) 與型別簽章為鍵，不含 parallel/fastmath；若直接編譯 _simulate，
+# 會載入一般版已寫入的序列機器碼。因此以同一份程式碼另建名為 _simulate_grid 的函式，快取項目各自獨立
+_simulate_grid = types.FunctionType(_simulate.__code__, _simulate.__globals__, "_simulate_grid")
+_simulate_grid.__qualname__ = "_simulate_grid"
+
+@st.cache_resource(show_spinner=False)
+def get_grid_simulator():
+    return njit(SIM_SIG, parallel=True, fastmath={"reassoc", "contract"}, cache=True)(_simulate_grid)
+
+# 蒙地卡羅核心 (Numba 平行)：各路徑獨立，以 prange 分散到多核心；每條路徑以 seed + i 設定亂數，結果可重現
+# 只保留前 n_keep 條路徑供繪圖 (破產後填 NaN)，其餘只記錄是否存活
+# 報酬表與繪圖路徑用 float32 (記憶體與傳給 Plotly 的資料量減半)；淨值累積仍用 float64，破產判斷不受捨入影響
+def _mc(rets, sim_count, sim_days, initial_capital, monthly_cf, seed, n_keep):
+    n_rets = len(rets)
+    paths = np.full((n_keep, sim_days + 1), np.nan, dtype=np.float32)
+    survived = np.zeros(sim_count, np.bool_)
+    for i in prange(sim_count):
+        np.random.seed(seed + i)
+        nav = initial_capital
+        if i < n_keep: paths[i, 0] = nav
+        ok = True
+        for d in range(sim_days):
+            nav = nav * (1 + rets[np.random.randint(0, n_rets)])
+            # 簡單現金流模擬：每 21 個交易日存入/提領 (已含信貸每月利息)
+            if (d + 1) % 21 == 0:
+                nav += monthly_cf
+            if nav <= 0:
+                if i < n_keep: paths[i, d + 1] = 0.0
+                ok = False
+                break
+            if i < n_keep: paths[i, d + 1] = nav
+        survived[i] = ok
+    return paths, survived
+
+@st.cache_resource(show_spinner=False)
+def get_mc():
+    return njit("Tuple((f4[:, ::1], b1[::1]))(f4[::1], i8, i8, f8, f8, i8, i8)", parallel=True, fastmath=True, cache=True)(_mc)
+
+# 回測前置：把 DataFrame 與資金參數轉成核心需要的陣列 (價格矩陣、日曆遮罩、每日現金流、信貸餘額、投入本金)
+def prepare_inputs(data, ticker_tuple, weights_tuple, initial_capital, loan_amount, weight_cash, cash_interest_rate,
+                   monthly_cashflow, loan_rate, loan_type, monthly_payment, repayment_source):
+    # 轉成 (T, N) 價格矩陣與日曆遮罩 (Numba 不認得 DataFrame / Timestamp)
+    # pandas 依欄存放，to_numpy 常得到 F-order；轉為 C-order 讓每日一列 prices[i] 在記憶體中連續
+    # 價格以 float32 傳入 (報價本身僅約 4 位小數，記憶體頻寬減半)；持股、現金與輸出仍用 float64 累積
+    # 一律複製成可寫入的陣列：pandas 3 單欄 to_numpy 會回傳唯讀 view，與核心簽章 f4[:, ::1] 不符
+    prices = np.array(data[list(ticker_tuple)].to_numpy(), dtype=np.float32, order="C")
+    weights = np.array(weights_tuple)
+
+    # 換月判斷：與前一交易日月份不同即為新月份 (不管1號是不是假日都會觸發)
+    months = data.index.month.to_numpy()
+    is_new_month = np.zeros(len(data), dtype=bool)
+    is_new_month[1:] = months[1:] != months[:-1]
+    # 年初判斷沿用日曆定義 (1/1)；DatetimeIndex.is_year_start 會受 freq 影響，故不直接使用
+    is_year_start = (months == 1) & (data.index.day.to_numpy() == 1)
+
+    # 只有在「換月」的第一個交易日執行扣款：以閉式還款表一次算出每日的信貸餘額、現金流與投入本金
+    T = len(data)
+    month_no = np.cumsum(is_new_month)  # 每個交易日已經過的扣款期數
+    balance, payment = loan_schedule(
+        loan_amount, loan_rate, monthly_payment, loan_type == "只繳息 (Interest Only)", month_no[-1]
+    )
+    loan_balance = balance[month_no]
+    payment_day = np.zeros(T)
+    payment_day[is_new_month] = payment
+
+    cash_flow = np.where(is_new_month, float(monthly_cashflow), 0.0)
+    contribution = np.where(is_new_month, float(max(monthly_cashflow, 0)), 0.0)
+    if repayment_source == "投資組合/賣股 (不增加投入成本)":
+        cash_flow -= payment_day
+    else:
+        contribution += payment_day
+    total_invested = initial_capital + np.cumsum(contribution)
+
+    kernel_args = (prices, is_new_month, is_year_start, weights,
+                   float(initial_capital + loan_amount), weight_cash / 100, cash_interest_rate, cash_flow, loan_balance)
+    return kernel_args, total_invested, loan_balance
+
+# 回測結果快取：相同資料與參數再次執行時直接取用，不重跑回測
+# 快取鍵含整份價格資料與所有參數，每次調整滑桿都會多一筆；限制筆數並與下載資料同樣 1 小時過期，避免伺服器記憶體無限成長
+@st.cache_data(ttl=3600, max_entries=32, show_spinner=False)
+def run_sim(data, ticker_tuple, weights_tuple, initial_capital, loan_amount, weight_cash, cash_interest_rate,
+            monthly_cashflow, loan_rate, loan_type, monthly_payment, repayment_source,
+            rebalance_mode, threshold_mode, threshold_pct):
+    kernel_args, total_invested, loan_balance = prepare_inputs(
+        data, ticker_tuple, weights_tuple, initial_capital, loan_amount, weight_cash, cash_interest_rate,
+        monthly_cashflow, loan_rate, loan_type, monthly_payment, repayment_source
+    )
+    T = len(data)
+    net_worth = np.empty((1, T))
+    cash = np.empty((1, T))
+    get_simulator()(
+        *kernel_args,
+        np.array([REBALANCE_MODES.index(rebalance_mode)], dtype=np.int64), np.array([threshold_mode]), np.array([threshold_pct], dtype=np.float64),
+        net_worth, cash
+    )
+
+    return pd.DataFrame({
+        "Date": data.index,
+        "Net Worth": net_worth[0],
+        "Total Invested": total_invested,
+        "Loan Balance": loan_balance,
+        "Cash": cash[0]
+    })
+
+# 策略掃描：同一組資料與資金設定下，一次平行跑「再平衡頻率 × 偏移閾值」所有組合，回傳各組合的最終淨資產
+# 欄位第一欄為不啟用閾值，其後為各閾值 (%)；快取上限同 run_sim
+@st.cache_data(ttl=3600, max_entries=32, show_spinner=False)
+def run_sweep(data, ticker_tuple, weights_tuple, initial_capital, loan_amount, weight_cash, cash_interest_rate,
+              monthly_cashflow, loan_rate, loan_type, monthly_payment, repayment_source, threshold_values):
+    kernel_args, _, _ = prepare_inputs(
+        data, ticker_tuple, weights_tuple, initial_capital, loan_amount, weight_cash, cash_interest_rate,
+        monthly_cashflow, loan_rate, loan_type, monthly_payment, repayment_source
+    )
+    thresholds = [0.0] + [v / 100 for v in threshold_values]
+    codes, thr = np.meshgrid(np.arange(len(REBALANCE_MODES), dtype=np.int64), np.array(thresholds), indexing="ij")
+    codes, thr = codes.ravel(), thr.ravel()
+    K, T = len(codes), len(data)
+    net_worth = np.empty((K, T))
+    cash = np.empty((K, T))
+    get_grid_simulator()(*kernel_args, codes, thr > 0, thr, net_worth, cash)
+
+    return pd.DataFrame(
+        net_worth[:, -1].reshape(len(REBALANCE_MODES), len(thresholds)),
+        index=REBALANCE_MODES, columns=["不啟用"] + [f"{v}%" for v in threshold_values]
+    )
+
+# 繪圖前等距抽樣 (保留頭尾)，避免把上萬個點送到瀏覽器；完整資料仍保留在 df_res
+MAX_PLOT_POINTS = 1500
+def plot_index(n, max_points=MAX_PLOT_POINTS):
+    if n <= max_points: return np.arange(n)
+    return np.unique(np.linspace(0, n - 1, max_points).astype(int))
+
+def downsample(df, max_points=MAX_PLOT_POINTS):
+    if len(df) <= max_points: return df
+    return df.iloc[plot_index(len(df), max_points)]
+
 # --- 4. 主程式邏輯 ---
 st.title("📈 全方位資產成長模擬器 (還款邏輯修復版)")
 
 # Session State 初始化
 if 'simulation_done' not in st.session_state: st.session_state.simulation_done = False
 if 'df_res' not in st.session_state: st.session_state.df_res = None
-if 'raw_data' not in st.session_state: st.session_state.raw_data = None
+if 'weighted_ret' not in st.session_state: st.session_state.weighted_ret = None
+if 'sim_args' not in st.session_state: st.session_state.sim_args = None
 
 if st.button("🚀 開始模擬運算", type="primary"):
     if weight_cash < 0: st.error("配置權重超過 100%！")
@@ -129,144 +372,30 @@ if st.button("🚀 開始模擬運算", type="primary"):
     else:
         with st.spinner('正在計算信貸現金流與回測...'):
             ticker_list = [a['ticker'] for a in assets]
-            data = get_data_safe(ticker_list, requested_start_date, end_date)
+            # 快取鍵與標的順序/重複無關：同一組代號不論排列都命中同一份下載
+            data = get_data_safe(tuple(sorted(set(ticker_list))), requested_start_date, end_date)
             
             if data.empty:
                 st.error("❌ 無法取得資料，請檢查代號。")
             else:
-                st.session_state.raw_data = data
-                
-                # 初始化
-                start_total_assets = initial_capital + loan_amount
-                current_cash = start_total_assets * (weight_cash / 100)
-                current_loan_balance = loan_amount
+                # 蒙地卡羅用的日報酬 (各標的平均，簡化假設) 在此算好一次，壓力測試按鈕直接取用
+                st.session_state.weighted_ret = data[ticker_list].pct_change().dropna().mean(axis=1).to_numpy(dtype=np.float32)
                 
-                shares = {}
-                first_prices = data.iloc[0]
-                
-                for asset in assets:
-                    t = asset['ticker']
-                    price = first_prices[t]
-                    if pd.isna(price) or price <= 0: price = data[t].dropna().iloc[0]
-                    shares[t] = (start_total_assets * asset['weight']) / price
-
-                history = []
-                total_invested = initial_capital
-                
-                # --- 修正重點：月份偵測變數 ---
-                last_month = None
-                
-                # 逐日回測
-                for date, row in data.iterrows():
-                    current_cash += current_cash * (cash_interest_rate / 365)
-                    
-                    # --- 修正重點：更精準的月初判斷 (不管1號是不是假日都會觸發) ---
-                    current_month = date.month
-                    is_new_month = False
-                    if last_month is None:
-                        last_month = current_month
-                    elif current_month != last_month:
-                        is_new_month = True
-                        last_month = current_month
-                    
-                    # 只有在「換月」的第一個交易日執行扣款
-                    if is_new_month:
-                        current_cash += monthly_cashflow
-                        if monthly_cashflow > 0:
-                            total_invested += monthly_cashflow
-                        
-                        if use_leverage and current_loan_balance > 0:
-                            interest_payment = current_loan_balance * (loan_rate / 12)
-                            
-                            if loan_type == "只繳息 (Interest Only)":
-                                payment_now = interest_payment
-                                principal_payment = 0
-                            else:
-                                payment_now = monthly_payment
-                                principal_payment = payment_now - interest_payment
-                                if principal_payment > current_loan_balance:
-                                    principal_payment = current_loan_balance
-                                    payment_now = principal_payment + interest_payment
-
-                            if repayment_source == "薪水/外部資金 (增加投入成本)":
-                                total_invested += payment_now
-                                current_loan_balance -= principal_payment
-                            else:
-                                current_cash -= payment_now
-                                current_loan_balance -= principal_payment
-                    
-                    stock_val = 0
-                    asset_vals = {}
-                    for t in ticker_list:
-                        if t in row:
-                            val = shares[t] * row[t]
-                            asset_vals[t] = val
-                            stock_val += val
-                    
-                    total_assets = current_cash + stock_val
-                    net_worth = total_assets - current_loan_balance
-
-                    do_rebalance = False
-                    if current_cash < 0: do_rebalance = True 
-                    # 這裡也要同步修正：使用 is_new_month 來觸發再平衡
-                    if rebalance_mode == "每月 (Monthly)" and is_new_month: do_rebalance = True
-                    elif rebalance_mode == "每年 (Yearly)" and date.is_year_start: do_rebalance = True
-                    
-                    if threshold_mode and total_assets > 0:
-                        for asset in assets:
-                            t = asset['ticker']
-                            if t in asset_vals:
-                                target = asset['weight']
-                                curr_w = asset_vals[t] / total_assets
-                                if abs(curr_w - target) > threshold_pct:
-                                    do_rebalance = True; break
-                    
-                    if do_rebalance and total_assets > 0:
-                        cost_stock = 0
-                        for asset in assets:
-                            t = asset['ticker']
-                            if t in row:
-                                target_val = total_assets * asset['weight']
-                                shares[t] = target_val / row[t]
-                                cost_stock += target_val
-                        current_cash = total_assets - cost_stock
-
-                    history.append({
-                        "Date": date, 
-                        "Net Worth": net_worth, 
-                        "Total Invested": total_invested, 
-                        "Loan Balance": current_loan_balance,
-                        "Cash": current_cash
-                    })
-
-                st.session_state.df_res = pd.DataFrame(history)
+                # 資料與資金設定另存一份，策略掃描沿用同一組輸入
+                st.session_state.sim_args = (
+                    data, tuple(ticker_list), tuple(a['weight'] for a in assets),
+                    initial_capital, loan_amount, weight_cash, cash_interest_rate, monthly_cashflow,
+                    loan_rate, loan_type, monthly_payment, repayment_source
+                )
+                st.session_state.df_res = run_sim(*st.session_state.sim_args, rebalance_mode, threshold_mode, threshold_pct)
                 st.session_state.simulation_done = True
                 st.rerun()
 
 
 # --- 顯示結果與進階分析 ---
-if st.session_state.simulation_done and st.session_state.df_res is not None:
-    df_res = st.session_state.df_res
-    data = st.session_state.raw_data
-    
-    final_nav = df_res.iloc[-1]['Net Worth']
-    final_inv = df_res.iloc[-1]['Total Invested']
-    final_loan = df_res.iloc[-1]['Loan Balance']
-    profit = final_nav - final_inv
-    roi = (profit/final_inv)*100 if final_inv>0 else 0
-    
-    st.markdown("### 📊 回測結果摘要")
-    c1, c2, c3, c4 = st.columns(4)
-    c1.metric("最終淨資產 (扣除信貸)", f"${int(final_nav):,}")
-    c2.metric("總投入本金 (含還款)", f"${int(final_inv):,}")
-    c3.metric("剩餘信貸本金", f"${int(final_loan):,}")
-    c4.metric("總損益 (ROI)", f"${int(profit):,}", f"{roi:.2f}%")
-
-    fig = px.line(df_res, x="Date", y=["Net Worth", "Total Invested", "Loan Balance"], 
-                  title="淨值成長 vs 投入成本 vs 信貸餘額",
-                  color_discrete_map={"Net Worth": "red", "Total Invested": "gray", "Loan Balance": "blue"})
-    st.plotly_chart(fig, use_container_width=True)
-    
+# 滾動報酬、壓力測試與策略掃描各自包成 fragment：調整區塊內的滑桿、輸入框或按下壓力測試時只重跑該區塊，不重跑整支程式與上方主圖
+@st.fragment
+def rolling_returns_section(df_res):
     # --- 滾動報酬 (Rolling Return) ---
     st.markdown("---")
     st.subheader("🔄 歷史滾動報酬分析 (Rolling Returns)")
@@ -277,25 +406,37 @@ if st.session_state.simulation_done and st.session_state.df_res is not None:
     
     window_days = int(roll_years * 252)
     if len(df_res) > window_days:
-        df_res['Rolling_CAGR'] = (df_res['Net Worth'] / df_res['Net Worth'].shift(window_days)).pow(1/roll_years) - 1
-        df_rolling = df_res.dropna(subset=['Rolling_CAGR'])
+        # 直接在 ndarray 上以切片對齊期初/期末 (取代 shift + dropna 的整欄運算)
+        nw = df_res['Net Worth'].to_numpy()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # (期末/期初)^(1/n) - 1 改以 expm1(log(.)/n) 計算：SIMD 化的 log/exp 較泛用 pow 快，小報酬時也更精確
+            ratio = nw[window_days:] / nw[:-window_days]
+            rolling_cagr = np.expm1(np.log(ratio) / roll_years)
+            # 淨值為負的罕見區段 log 無定義，沿用 pow 的結果 (n=1 時仍有值)
+            neg = ratio < 0
+            if neg.any(): rolling_cagr[neg] = ratio[neg] ** (1 / roll_years) - 1
+        valid = ~np.isnan(rolling_cagr)
+        rolling_cagr = rolling_cagr[valid]
+        df_rolling = pd.DataFrame({"Date": df_res['Date'].to_numpy()[window_days:][valid], "Rolling_CAGR": rolling_cagr})
         
-        win_rate = (df_rolling['Rolling_CAGR'] > target_return_pct).mean() * 100
-        avg_ret = df_rolling['Rolling_CAGR'].mean() * 100
-        min_ret = df_rolling['Rolling_CAGR'].min() * 100
+        win_rate = (rolling_cagr > target_return_pct).mean() * 100
+        avg_ret = rolling_cagr.mean() * 100
+        min_ret = rolling_cagr.min() * 100
         
         m1, m2, m3 = st.columns(3)
         m1.metric(f"持有 {roll_years} 年勝率", f"{win_rate:.1f}%")
         m2.metric("平均年化報酬", f"{avg_ret:.2f}%")
         m3.metric("最差年化報酬", f"{min_ret:.2f}%")
         
-        fig_roll = px.line(df_rolling, x="Date", y="Rolling_CAGR", title=f"滾動 {roll_years} 年化報酬率")
+        fig_roll = px.line(downsample(df_rolling), x="Date", y="Rolling_CAGR", title=f"滾動 {roll_years} 年化報酬率")
         fig_roll.add_hline(y=target_return_pct, line_dash="dash", line_color="red")
         fig_roll.layout.yaxis.tickformat = ',.1%'
         st.plotly_chart(fig_roll, use_container_width=True)
     else:
         st.warning("資料長度不足以計算此年數的滾動報酬。")
 
+@st.fragment
+def monte_carlo_section(weighted_ret, initial_capital, monthly_cf):
     # --- 蒙地卡羅 (Monte Carlo) ---
     st.markdown("---")
     st.subheader("🎲 蒙地卡羅壓力測試")
@@ -307,41 +448,69 @@ if st.session_state.simulation_done and st.session_state.df_res is not None:
     
     if st.button("開始壓力測試"):
         with st.spinner("正在運算..."):
-            daily_returns = data.pct_change().dropna()
-            ticker_list = [a['ticker'] for a in assets]
-            valid_cols = [c for c in ticker_list if c in daily_returns.columns]
-            
-            if valid_cols:
-                daily_returns = daily_returns[valid_cols]
-                weighted_ret = daily_returns.mean(axis=1) # 簡化假設
-                
-                sim_days = sim_years * 252
-                success_count = 0
+            if len(weighted_ret) > 0:
+                sim_days = int(sim_years * 252)
+                sim_count = int(sim_count)
+
+                paths, survived = get_mc()(
+                    weighted_ret, sim_count, sim_days, initial_capital, monthly_cf,
+                    np.random.randint(2**31 - 1), min(sim_count, 50)
+                )
+                success_count = survived.sum()
+
                 fig_mc = go.Figure()
-                
-                for i in range(sim_count):
-                    random_rets = weighted_ret.sample(n=sim_days, replace=True).values
-                    nav = initial_capital # 蒙地卡羅僅模擬淨值波動，不詳細計算複雜本利攤還
-                    survived = True
-                    path = [nav]
-                    
-                    for d in range(sim_days):
-                        nav = nav * (1 + random_rets[d])
-                        # 簡單現金流模擬
-                        if (d+1) % 21 == 0:
-                            nav += monthly_cashflow
-                            # 若有信貸，模擬每月扣息風險
-                            if use_leverage: 
-                                nav -= (loan_amount * loan_rate / 12)
-                        
-                        if nav <= 0:
-                            nav = 0; survived = False; path.append(0); break
-                        path.append(nav)
-                    
-                    if survived: success_count += 1
-                    if i < 50:
-                        fig_mc.add_trace(go.Scatter(y=path, mode='lines', line=dict(width=1, color='rgba(200,200,200,0.5)'), showlegend=False))
-                
+                for path in paths:
+                    path = path[~np.isnan(path)]
+                    # 每條路徑抽樣後以交易日序號為 x 軸，曲線長度與未抽樣時相同
+                    idx = plot_index(len(path))
+                    fig_mc.add_trace(go.Scatter(x=idx, y=path[idx], mode='lines', line=dict(width=1, color='rgba(200,200,200,0.5)'), showlegend=False))
+
                 rate = (success_count / sim_count) * 100
                 st.metric("模擬成功率", f"{rate:.1f}%")
                 st.plotly_chart(fig_mc, use_container_width=True)
+
+@st.fragment
+def sweep_section(sim_args):
+    # --- 再平衡策略掃描 (Grid Sweep) ---
+    st.markdown("---")
+    st.subheader("🧪 再平衡策略掃描")
+    st.caption("以相同資料與資金設定，平行回測所有「再平衡頻率 × 偏移閾值」組合，比較最終淨資產。")
+
+    thr_lo, thr_hi = st.slider("偏移閾值範圍 (%)", 1, 20, (1, 10))
+
+    if st.button("開始掃描"):
+        with st.spinner("正在運算..."):
+            df_sweep = run_sweep(*sim_args, tuple(range(thr_lo, thr_hi + 1)))
+            fig_sweep = px.imshow(df_sweep, text_auto=",.0f", aspect="auto", color_continuous_scale="RdYlGn",
+                                  labels=dict(x="偏移閾值", y="再平衡頻率", color="最終淨資產"),
+                                  title="各策略最終淨資產 (扣除信貸)")
+            st.plotly_chart(fig_sweep, use_container_width=True)
+
+if st.session_state.simulation_done and st.session_state.df_res is not None:
+    df_res = st.session_state.df_res
+    weighted_ret = st.session_state.weighted_ret
+    
+    # 結果已依日期排序，直接取各欄最後一筆 (iloc[-1] 會先把整列組成混合型別的 Series)
+    final_nav = df_res['Net Worth'].iat[-1]
+    final_inv = df_res['Total Invested'].iat[-1]
+    final_loan = df_res['Loan Balance'].iat[-1]
+    profit = final_nav - final_inv
+    roi = (profit/final_inv)*100 if final_inv>0 else 0
+    
+    st.markdown("### 📊 回測結果摘要")
+    c1, c2, c3, c4 = st.columns(4)
+    c1.metric("最終淨資產 (扣除信貸)", f"${int(final_nav):,}")
+    c2.metric("總投入本金 (含還款)", f"${int(final_inv):,}")
+    c3.metric("剩餘信貸本金", f"${int(final_loan):,}")
+    c4.metric("總損益 (ROI)", f"${int(profit):,}", f"{roi:.2f}%")
+
+    fig = px.line(downsample(df_res), x="Date", y=["Net Worth", "Total Invested", "Loan Balance"], 
+                  title="淨值成長 vs 投入成本 vs 信貸餘額",
+                  color_discrete_map={"Net Worth": "red", "Total Invested": "gray", "Loan Balance": "blue"})
+    st.plotly_chart(fig, use_container_width=True)
+    
+    rolling_returns_section(df_res)
+    # 蒙地卡羅僅模擬淨值波動，不詳細計算複雜本利攤還；若有信貸，每月再扣利息
+    monte_carlo_section(weighted_ret, float(initial_capital),
+                        float(monthly_cashflow - (loan_amount * loan_rate / 12 if use_leverage else 0)))
+    if st.session_state.sim_args is not None: sweep_section(st.session_state.sim_args)
@@ -0,0 +1,234 @@
+import atexit
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# 測試以模組名稱 app 匯入，Numba 快取會記下模組名稱；若與 Streamlit (以 __main__ 執行) 共用 __pycache__ 內的快取，
+# 之後載入時會重新 import app 而整支程式在快取函式內被執行。測試的編譯快取因此另放暫存目錄 (須在 import numba 之前設定)，
+# 測試結束後刪除
+NUMBA_CACHE_DIR = tempfile.mkdtemp(prefix="numba-test-")
+atexit.register(shutil.rmtree, NUMBA_CACHE_DIR, ignore_errors=True)
+os.environ["NUMBA_CACHE_DIR"] = NUMBA_CACHE_DIR
+
+import numba
+import app
+
+AMORTIZED = "本利攤還 (Amortized)"
+INTEREST_ONLY = "只繳息 (Interest Only)"
+FROM_SALARY = "薪水/外部資金 (增加投入成本)"
+FROM_PORTFOLIO = "投資組合/賣股 (不增加投入成本)"
+MONTHLY, YEARLY, NONE = app.REBALANCE_MODES
+
+
+# 測試用價格：固定亂數種子的幾何隨機漫步 (含 1/1 的工作日，年度再平衡會被觸發)
+# 先轉成 float32 再轉回，核心與原始迴圈看到完全相同的報價，比較時可用很嚴格的容許誤差
+def make_prices(tickers, start="2015-01-01", end="2021-12-31"):
+    idx = pd.bdate_range(start, end)
+    rng = np.random.default_rng(42)
+    cols = {t: 50 * np.exp(np.cumsum(rng.normal(0.0004, 0.02, len(idx)))) for t in tickers}
+    return pd.DataFrame(cols, index=idx).astype(np.float32).astype(np.float64)
+
+
+def monthly_payment_for(loan_amount, loan_rate, loan_type, loan_years):
+    if loan_type == INTEREST_ONLY: return loan_amount * (loan_rate / 12)
+    return -app.calculate_pmt(loan_rate / 12, loan_years * 12, loan_amount)
+
+
+# 原始版本的逐日回測迴圈 (改寫前的 app.py)，作為新核心的對照組
+def baseline_backtest(data, assets, initial_capital, loan_amount, weight_cash, cash_interest_rate, monthly_cashflow,
+                      loan_rate, loan_type, monthly_payment, repayment_source, rebalance_mode, threshold_mode, threshold_pct):
+    use_leverage = loan_amount > 0
+    ticker_list = [a['ticker'] for a in assets]
+    start_total_assets = initial_capital + loan_amount
+    current_cash = start_total_assets * (weight_cash / 100)
+    current_loan_balance = loan_amount
+
+    shares = {}
+    first_prices = data.iloc[0]
+    for asset in assets:
+        t = asset['ticker']
+        shares[t] = (start_total_assets * asset['weight']) / first_prices[t]
+
+    history = []
+    total_invested = initial_capital
+    last_month = None
+    for date, row in data.iterrows():
+        current_cash += current_cash * (cash_interest_rate / 365)
+
+        current_month = date.month
+        is_new_month = False
+        if last_month is None:
+            last_month = current_month
+        elif current_month != last_month:
+            is_new_month = True
+            last_month = current_month
+
+        if is_new_month:
+            current_cash += monthly_cashflow
+            if monthly_cashflow > 0:
+                total_invested += monthly_cashflow
+
+            if use_leverage and current_loan_balance > 0:
+                interest_payment = current_loan_balance * (loan_rate / 12)
+                if loan_type == INTEREST_ONLY:
+                    payment_now = interest_payment
+                    principal_payment = 0
+                else:
+                    payment_now = monthly_payment
+                    principal_payment = payment_now - interest_payment
+                    if principal_payment > current_loan_balance:
+                        principal_payment = current_loan_balance
+                        payment_now = principal_payment + interest_payment
+
+                if repayment_source == FROM_SALARY:
+                    total_invested += payment_now
+                else:
+                    current_cash -= payment_now
+                current_loan_balance -= principal_payment
+
+        stock_val = 0
+        asset_vals = {}
+        for t in ticker_list:
+            val = shares[t] * row[t]
+            asset_vals[t] = val
+            stock_val += val
+
+        total_assets = current_cash + stock_val
+        net_worth = total_assets - current_loan_balance
+
+        do_rebalance = False
+        if current_cash < 0: do_rebalance = True
+        if rebalance_mode == MONTHLY and is_new_month: do_rebalance = True
+        elif rebalance_mode == YEARLY and date.is_year_start: do_rebalance = True
+
+        if threshold_mode and total_assets > 0:
+            for asset in assets:
+                t = asset['ticker']
+                if abs(asset_vals[t] / total_assets - asset['weight']) > threshold_pct:
+                    do_rebalance = True; break
+
+        if do_rebalance and total_assets > 0:
+            cost_stock = 0
+            for asset in assets:
+                t = asset['ticker']
+                target_val = total_assets * asset['weight']
+                shares[t] = target_val / row[t]
+                cost_stock += target_val
+            current_cash = total_assets - cost_stock
+
+        history.append({"Net Worth": net_worth, "Total Invested": total_invested,
+                        "Loan Balance": current_loan_balance, "Cash": current_cash})
+    return pd.DataFrame(history)
+
+
+# 新版：prepare_inputs + 編譯後的核心 (與 run_sim 相同的呼叫方式)
+def kernel_backtest(data, assets, initial_capital, loan_amount, weight_cash, cash_interest_rate, monthly_cashflow,
+                    loan_rate, loan_type, monthly_payment, repayment_source, rebalance_mode, threshold_mode, threshold_pct):
+    kernel_args, total_invested, loan_balance = app.prepare_inputs(
+        data, tuple(a['ticker'] for a in assets), tuple(a['weight'] for a in assets),
+        initial_capital, loan_amount, weight_cash, cash_interest_rate,
+        monthly_cashflow, loan_rate, loan_type, monthly_payment, repayment_source
+    )
+    net_worth = np.empty((1, len(data)))
+    cash = np.empty((1, len(data)))
+    app.get_simulator()(
+        *kernel_args,
+        np.array([app.REBALANCE_MODES.index(rebalance_mode)], dtype=np.int64),
+        np.array([threshold_mode]), np.array([threshold_pct], dtype=np.float64),
+        net_worth, cash
+    )
+    return pd.DataFrame({"Net Worth": net_worth[0], "Total Invested": total_invested,
+                         "Loan Balance": loan_balance, "Cash": cash[0]})
+
+
+# (標的與權重 %, 自備本金, 每月現金流, 現金利率, 借貸金額, 借貸利率, 還款模式, 年限, 還款來源, 再平衡, 閾值 %)
+# 信貸參數選在原始迴圈剛好於年限內繳清的組合 (原始迴圈在部分利率下會多出一期浮點殘值的還款)
+# 全額投入 (現金 0%) 的情境只用加總恰為 1 的權重：原始迴圈的 total - Σ目標市值 在其他權重下可能是微小負值，
+# 會多觸發幾次再平衡 (新版直接取 cash_weight，見下方 test_fully_invested_rebalance_keeps_cash_at_zero)
+CASES = {
+    "1 ticker, fully invested, monthly": ([("AAA", 100)], 500000, 0, 0.015, 0, 0.0, AMORTIZED, 7, FROM_SALARY, MONTHLY, None),
+    "1 ticker, salary-funded loan, yearly": ([("AAA", 60)], 500000, 10000, 0.015, 1000000.0, 0.03, AMORTIZED, 3, FROM_SALARY, YEARLY, None),
+    "0% cash, portfolio-funded loan, buy & hold": ([("AAA", 50), ("BBB", 50)], 300000, 0, 0.015, 1000000.0, 0.03, AMORTIZED, 3, FROM_PORTFOLIO, NONE, None),
+    "0% cash, portfolio-funded 0% loan, monthly": ([("AAA", 50), ("BBB", 50)], 100000, 0, 0.0, 3000000.0, 0.0, AMORTIZED, 3, FROM_PORTFOLIO, MONTHLY, None),
+    "portfolio-funded loan, yearly + threshold": ([("AAA", 30), ("BBB", 30), ("CCC", 20)], 1000000, 0, 0.015, 2000000.0, 0.08, AMORTIZED, 2, FROM_PORTFOLIO, YEARLY, 3),
+    "interest only, withdrawals, monthly + threshold": ([("AAA", 40), ("BBB", 30)], 2000000, -20000, 0.02, 1000000.0, 0.03, INTEREST_ONLY, 7, FROM_SALARY, MONTHLY, 5),
+    "no loan, contributions, buy & hold + threshold": ([("AAA", 30), ("BBB", 20), ("CCC", 20), ("DDD", 10), ("EEE", 5)], 300000, 5000, 0.01, 0, 0.0, AMORTIZED, 7, FROM_SALARY, NONE, 1),
+}
+
+
+# 情境展開為 (價格, 標的, 資金參數)；資金參數依序對應 run_sim / kernel_backtest 在 data, assets 之後的參數 (不含再平衡設定)
+def case_inputs(case):
+    holdings, capital, cashflow, cash_rate, loan, loan_rate, loan_type, loan_years, source, _, _ = case
+    assets = [{'ticker': t, 'weight': w / 100} for t, w in holdings]
+    data = make_prices([t for t, _ in holdings])
+    funding = (capital, loan, 100 - sum(w for _, w in holdings), cash_rate, cashflow,
+               loan_rate, loan_type, monthly_payment_for(loan, loan_rate, loan_type, loan_years), source)
+    return data, assets, funding
+
+
+@pytest.mark.parametrize("case", CASES.values(), ids=CASES.keys())
+def test_kernel_matches_baseline_loop(case):
+    data, assets, funding = case_inputs(case)
+    mode, threshold = case[-2:]
+    params = (*funding, mode, threshold is not None, (threshold or 5) / 100)
+
+    expected = baseline_backtest(data, assets, *params)
+    result = kernel_backtest(data, assets, *params)
+
+    scale = max(1.0, np.abs(expected.to_numpy()).max())
+    np.testing.assert_allclose(result.to_numpy(), expected.to_numpy(), rtol=0, atol=1e-9 * scale)
+
+
+# 閉式還款表必須在年限到期那一期剛好歸零，之後不再有任何還款
+@pytest.mark.parametrize("loan_amount", [100000.0, 1000000.0, 3000000.0, 12345678.9])
+@pytest.mark.parametrize("loan_rate", [0.0, 0.005, 0.02, 0.03, 0.075, 0.145])
+@pytest.mark.parametrize("loan_years", [1, 2, 3, 7, 20, 30])
+def test_loan_schedule_pays_off_at_term(loan_amount, loan_rate, loan_years):
+    n = loan_years * 12
+    payment = monthly_payment_for(loan_amount, loan_rate, AMORTIZED, loan_years)
+    balance, paid = app.loan_schedule(loan_amount, loan_rate, payment, False, n + 24)
+    assert (balance[:n] > 0).all()
+    assert (balance[n:] == 0).all()
+    assert (paid[n:] == 0).all()
+
+
+# 權重加總為 100% 時 sum(w/100) 可能是 1.0000000000000002；再平衡後現金必須恰為 0，不能變成負值而每天觸發再平衡
+@pytest.mark.parametrize("weights", [(33, 56, 11), (30, 30, 40), (17, 29, 54)])
+def test_fully_invested_rebalance_keeps_cash_at_zero(weights):
+    assets = [{'ticker': t, 'weight': w / 100} for t, w in zip(("AAA", "BBB", "CCC"), weights)]
+    data = make_prices(["AAA", "BBB", "CCC"])
+    result = kernel_backtest(data, assets, 1000000, 0, 0, 0.015, 0, 0.0, AMORTIZED, 0.0, FROM_SALARY, MONTHLY, False, 0.05)
+    assert (result["Cash"] == 0).all()
+
+
+# 策略掃描 (平行核心 + meshgrid 展開 + reshape 回表格) 的每一格，都必須等於單獨回測該組合的最終淨資產
+SWEEP_THRESHOLDS = (1, 3, 5)
+SWEEP_CASES = ["portfolio-funded loan, yearly + threshold", "interest only, withdrawals, monthly + threshold"]
+
+@pytest.mark.parametrize("case", [CASES[c] for c in SWEEP_CASES], ids=SWEEP_CASES)
+def test_sweep_matches_single_backtests(case):
+    data, assets, funding = case_inputs(case)
+    table = app.run_sweep(data, tuple(a['ticker'] for a in assets), tuple(a['weight'] for a in assets),
+                          *funding, SWEEP_THRESHOLDS)
+    assert list(table.index) == list(app.REBALANCE_MODES)
+    assert list(table.columns) == ["不啟用"] + [f"{v}%" for v in SWEEP_THRESHOLDS]
+    for mode in app.REBALANCE_MODES:
+        for col, threshold in zip(table.columns, (None,) + SWEEP_THRESHOLDS):
+            result = kernel_backtest(data, assets, *funding, mode, threshold is not None, (threshold or 0) / 100)
+            assert table.loc[mode, col] == pytest.approx(result["Net Worth"].iat[-1], rel=1e-12)
+
+
+# 平行版與一般版編譯自同一支核心；Numba 磁碟快取的鍵不含 parallel/fastmath 選項，
+# 若兩者共用快取項目，平行版會直接載入一般版已寫入的序列機器碼
+def test_grid_simulator_does_not_load_serial_cache(tmp_path, monkeypatch):
+    # Numba 會在編譯時重新讀取環境變數 (reload_config)，環境變數與已載入的設定都要改
+    monkeypatch.setenv("NUMBA_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(numba.config, "CACHE_DIR", str(tmp_path))
+    app.get_simulator.clear()
+    app.get_grid_simulator.clear()
+    app.get_simulator()
+    assert not app.get_grid_simulator().stats.cache_hits